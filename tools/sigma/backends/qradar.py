@@ -16,12 +16,31 @@
 
 
 import re
+from functools import lru_cache
 import sigma
 from sigma.parser.modifiers.base import SigmaTypeModifier
 from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
 from .base import SingleTextQueryBackend
 from .mixins import MultiRuleOutputMixin
 
+# Sigma timeframe suffix to AQL time unit, anything else is taken as months
+_TIME_UNITS = {
+    "s": "seconds",
+    "m": "minutes",
+    "h": "hours",
+    "d": "days"
+}
+
+
+@lru_cache(maxsize=1024)
+def _anchorRegex(regex):
+    """Regular Expressions have to match the full value in QRadar"""
+    if not (regex.startswith('^') or regex.startswith('.*')):
+        regex = '.*' + regex
+    if not (regex.endswith('$') or regex.endswith('.*')):
+        regex = regex + '.*'
+    return regex
+
 
 class QRadarBackend(SingleTextQueryBackend):
     """Converts Sigma rule into Qradar saved search. Contributed by SOC Prime. https://socprime.com"""
@@ -44,6 +63,26 @@ class QRadarBackend(SingleTextQueryBackend):
     mapExpression = "%s=%s"
     mapListsSpecialHandling = True
     aql_database = "events"
+    aggPrefixExpression = "SELECT %s(%s) as agg_val from %s where"
+    aggSuffixExpression = " group by %s having agg_val %s %s"
+    aggTimeframeSuffixExpression = " group by %s having agg_val %s %s LAST %s %s"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Node type to generator lookup used by generateNode
+        generateValue = lambda node: self.generateValueNode(node, False)
+        self._nodeDispatch = {
+            sigma.parser.condition.ConditionAND: self.generateANDNode,
+            sigma.parser.condition.ConditionOR: self.generateORNode,
+            sigma.parser.condition.ConditionNOT: self.generateNOTNode,
+            sigma.parser.condition.ConditionNULLValue: self.generateNULLValueNode,
+            sigma.parser.condition.ConditionNotNULLValue: self.generateNotNULLValueNode,
+            sigma.parser.condition.NodeSubexpression: self.generateSubexpressionNode,
+            tuple: self.generateMapItemNode,
+            str: generateValue,
+            int: generateValue,
+            list: self.generateListNode,
+        }
 
     def cleanKey(self, key):
         if key == None:
@@ -59,27 +98,10 @@ class QRadarBackend(SingleTextQueryBackend):
         return value.replace("\'","\\\'")
 
     def generateNode(self, node):
-        if type(node) == sigma.parser.condition.ConditionAND:
-            return self.generateANDNode(node)
-        elif type(node) == sigma.parser.condition.ConditionOR:
-            return self.generateORNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNOT:
-            return self.generateNOTNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNULLValue:
-            return self.generateNULLValueNode(node)
-        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
-            return self.generateNotNULLValueNode(node)
-        elif type(node) == sigma.parser.condition.NodeSubexpression:
-            return self.generateSubexpressionNode(node)
-        elif type(node) == tuple:
-            return self.generateMapItemNode(node)
-        elif type(node) in (str, int):
-            return self.generateValueNode(node, False)
-        elif type(node) == list:
-            return self.generateListNode(node)
-        else:
+        handler = self._nodeDispatch.get(type(node))
+        if handler is None:
             raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
-
+        return handler(node)
 
     def generateMapItemNode(self, node):
         key, value = node
@@ -101,27 +123,25 @@ class QRadarBackend(SingleTextQueryBackend):
             raise TypeError("Backend does not support map values of type " + str(type(value)))
 
     def generateMapItemListNode(self, key, value):
+        cleanedKey = self.cleanKey(key)
+        isIp = "ip" in key
         itemslist = list()
+        append = itemslist.append
         for item in value:
             if item is None:
-                itemslist.append(self.nullExpression % (key))
-            elif type(item) == str and "ip" in key and ("/16" in item or "/24" in item):
-                itemslist.append("INCIDR(%s, %s)" % (self.generateValueNode(item, True), self.cleanKey(key)))
+                append(self.nullExpression % (key))
+            elif type(item) == str and isIp and ("/16" in item or "/24" in item):
+                append("INCIDR(%s, %s)" % (self.generateValueNode(item, True), cleanedKey))
             elif type(item) == str and "*" in item:
                 item = item.replace("*", "%")
-                itemslist.append('%s ilike %s' % (self.cleanKey(key), self.generateValueNode(item, True)))
+                append('%s ilike %s' % (cleanedKey, self.generateValueNode(item, True)))
             else:
-                itemslist.append('%s = %s' % (self.cleanKey(key), self.generateValueNode(item, True)))
-        return '('+" or ".join(itemslist)+')'
+                append('%s = %s' % (cleanedKey, self.generateValueNode(item, True)))
+        return "(%s)" % " or ".join(itemslist)
 
     def generateMapItemTypedNode(self, fieldname, value):
         if type(value) == SigmaRegularExpressionModifier:
-            regex = str(value)
-            # Regular Expressions have to match the full value in QRadar
-            if not (regex.startswith('^') or regex.startswith('.*')):
-                regex = '.*' + regex
-            if not (regex.endswith('$') or regex.endswith('.*')):
-                regex = regex + '.*'
+            regex = _anchorRegex(str(value))
             return "%s imatches %s" % (self.cleanKey(fieldname), self.generateValueNode(regex, True))
         else:
             raise NotImplementedError("Type modifier '{}' is not supported by backend".format(value.identifier))
@@ -143,39 +163,25 @@ class QRadarBackend(SingleTextQueryBackend):
             return ""
         if agg.aggfunc == sigma.parser.condition.SigmaAggregationParser.AGGFUNC_NEAR:
             raise NotImplementedError("The 'near' aggregation operator is not yet implemented for this backend")
+        aggfield = self.cleanKey(agg.aggfield)
+        prefix = self.aggPrefixExpression % (agg.aggfunc_notrans, aggfield, self.aql_database)
         if agg.groupfield == None:
-            self.qradarPrefixAgg = "SELECT %s(%s) as agg_val from %s where" % (agg.aggfunc_notrans, self.cleanKey(agg.aggfield), self.aql_database)
-            self.qradarSuffixAgg = " group by %s having agg_val %s %s" % (self.cleanKey(agg.aggfield), agg.cond_op, agg.condition)
+            self.qradarPrefixAgg = prefix
+            self.qradarSuffixAgg = self.aggSuffixExpression % (aggfield, agg.cond_op, agg.condition)
             return self.qradarPrefixAgg, self.qradarSuffixAgg
-        elif agg.groupfield != None and timeframe == '00':
-                self.qradarPrefixAgg = " SELECT %s(%s) as agg_val from %s where " % (agg.aggfunc_notrans, self.cleanKey(agg.aggfield), self.aql_database)
-                self.qradarSuffixAgg = " group by %s having agg_val %s %s" % (self.cleanKey(agg.groupfield), agg.cond_op, agg.condition)
-                return self.qradarPrefixAgg, self.qradarSuffixAgg
-        elif agg.groupfield != None and timeframe != None:
-            for key, duration in self.generateTimeframe(timeframe).items():
-                self.qradarPrefixAgg = " SELECT %s(%s) as agg_val from %s where " % (agg.aggfunc_notrans, self.cleanKey(agg.aggfield), self.aql_database)
-                self.qradarSuffixAgg = " group by %s having agg_val %s %s LAST %s %s" % (self.cleanKey(agg.groupfield), agg.cond_op, agg.condition, duration, key)
-                return self.qradarPrefixAgg, self.qradarSuffixAgg
+
+        groupfield = self.cleanKey(agg.groupfield)
+        self.qradarPrefixAgg = " %s " % (prefix)
+        if timeframe != '00' and timeframe != None:
+            key, duration = next(iter(self.generateTimeframe(timeframe).items()))
+            self.qradarSuffixAgg = self.aggTimeframeSuffixExpression % (groupfield, agg.cond_op, agg.condition, duration, key)
         else:
-            self.qradarPrefixAgg = " SELECT %s(%s) as agg_val from %s where " % (agg.aggfunc_notrans, self.cleanKey(agg.aggfield), self.aql_database)
-            self.qradarSuffixAgg = " group by %s having agg_val %s %s" % (self.cleanKey(agg.groupfield), agg.cond_op, agg.condition)
-            return self.qradarPrefixAgg, self.qradarSuffixAgg
+            self.qradarSuffixAgg = self.aggSuffixExpression % (groupfield, agg.cond_op, agg.condition)
+        return self.qradarPrefixAgg, self.qradarSuffixAgg
 
     def generateTimeframe(self, timeframe):
-        time_unit = timeframe[-1:]
-        duration = timeframe[:-1]
-        timeframe_object = {}
-        if time_unit == "s":
-            timeframe_object['seconds'] = int(duration)
-        elif time_unit == "m":
-            timeframe_object['minutes'] = int(duration)
-        elif time_unit == "h":
-            timeframe_object['hours'] = int(duration)
-        elif time_unit == "d":
-            timeframe_object['days'] = int(duration)
-        else:
-            timeframe_object['months'] = int(duration)
-        return timeframe_object
+        unit = _TIME_UNITS.get(timeframe[-1:], "months")
+        return {unit: int(timeframe[:-1])}
 
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
@@ -197,26 +203,15 @@ class QRadarBackend(SingleTextQueryBackend):
     def generateQuery(self, parsed, sigmaparser):
         result = self.generateNode(parsed.parsedSearch)
         self.parsedlogsource = sigmaparser.get_logsource().index
-        if any("flow" in i for i in self.parsedlogsource):
-            aql_database = "flows"
-        else:
-            aql_database = "events"
-
-        qradarPrefix="SELECT UTF8(payload) as search_payload"
-        try:
-            mappedFields = []
-            for field in sigmaparser.parsedyaml["fields"]:
-                    mapped = sigmaparser.config.get_fieldmapping(field).resolve_fieldname(field, sigmaparser)
-                    mappedFields.append(mapped)
-                    if " " in mapped and not "(" in mapped:
-                        qradarPrefix += ", \"" + mapped + "\""
-                    else:
-                        qradarPrefix +=  ", " + mapped
-
-        except KeyError:    # no 'fields' attribute
-            mapped = None
-            pass
-        qradarPrefix += " from %s where " % (aql_database)
+        # Index names are joined with a separator that can't occur in them to test all at once
+        aql_database = "flows" if "flow" in "\x00".join(self.parsedlogsource) else "events"
+
+        columns = ""
+        fields = sigmaparser.parsedyaml.get("fields")
+        if fields:
+            mappedFields = [sigmaparser.config.get_fieldmapping(field).resolve_fieldname(field, sigmaparser) for field in fields]
+            columns = "".join(", \"%s\"" % mapped if " " in mapped and not "(" in mapped else ", " + mapped for mapped in mappedFields)
+        qradarPrefix = "SELECT UTF8(payload) as search_payload%s from %s where " % (columns, aql_database)
 
         try:
             timeframe = sigmaparser.parsedyaml['detection']['timeframe']
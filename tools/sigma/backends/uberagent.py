@@ -1,4 +1,6 @@
 import re
+import shutil
+import tempfile
 import sigma
 from sigma.backends.base import SingleTextQueryBackend
 from sigma.parser.condition import SigmaAggregationParser, NodeSubexpression, ConditionAND, ConditionOR, ConditionNOT
@@ -10,53 +12,63 @@ from ..parser.modifiers.base import SigmaTypeModifier
 
 gUnsupportedCategories = {}
 
+# Patterns used by uberAgentBackend.cleanValue.
+# Single backlashes which are not in front of * or ? are doubled
+_RE_ESC_BS = re.compile(r"(?<!\\)\\(?!(\\|\*|\?))")
+# Replace " with \" because " is a string literal symbol and must be escaped
+_RE_QUOT = re.compile(r'"')
+# Replace * with %, if even number of backslashes (or zero) in front of *
+_RE_STAR = re.compile(r"(?<!\\)(\\\\)*(?!\\)\*")
+# Replace ? with _, if even number of backslashes (or zero) in front of ?
+_RE_QMARK = re.compile(r"(?<!\\)(\\\\)*(?!\\)\?")
+
+# Matches escaped or plain wildcards in a generated value.
+_RE_WILDCARD = re.compile(r"((\\(\*|\?|\\))|\*|\?|_|%)")
+
+# Collapses runs of dashes in generated tags.
+_RE_MULTI_DASH = re.compile(r"-{2,}")
+
+
+_LEVELS = {
+    "critical": 100,
+    "high": 75,
+    "medium": 50,
+    "low": 25
+}
+
+_CATEGORIES = {
+    "process_creation": "Process.Start",
+    "image_load": "Image.Load",
+    "dns": "Dns.Query",
+    "dns_query": "Dns.Query",
+    "network_connection": "Net.Any",
+    "firewall": "Net.Any",
+    "create_remote_thread": "Process.CreateRemoteThread",
+    "registry_event": "Reg.Any",
+    "registry_add": "Reg.Any",
+    "registry_delete": "Reg.Any",
+    "registry_set": "Reg.Any",
+    "registry_rename": "Reg.Any"
+}
+
 
 def convert_sigma_level_to_uberagent_risk_score(level):
     """Converts the given Sigma rule level to uberAgent ESA RiskScore property."""
-    levels = {
-        "critical": 100,
-        "high": 75,
-        "medium": 50,
-        "low": 25
-    }
-
-    if level in levels:
-        return levels[level]
-
-    return 0
+    return _LEVELS.get(level, 0)
 
 
 def convert_sigma_name_to_uberagent_tag(name):
     """Converts the given Sigma rule name to uberAgent ESA Tag property."""
     tag = name.lower().replace(" ", "-")
-    tag = re.sub(r"-{2,}", "-", tag, 0, re.IGNORECASE)
-    return tag
+    return _RE_MULTI_DASH.sub("-", tag)
 
 
 def convert_sigma_category_to_uberagent_event_type(category):
-    categories = {
-        "process_creation": "Process.Start",
-        "image_load": "Image.Load",
-        "dns": "Dns.Query",
-        "dns_query": "Dns.Query",
-        "network_connection": "Net.Any",
-        "firewall": "Net.Any",
-        "create_remote_thread": "Process.CreateRemoteThread",
-        "registry_event": "Reg.Any",
-        "registry_add": "Reg.Any",
-        "registry_delete": "Reg.Any",
-        "registry_set": "Reg.Any",
-        "registry_rename": "Reg.Any"
-    }
-
-    if category in categories:
-        return categories[category]
-
-    if category in gUnsupportedCategories:
-        gUnsupportedCategories[category] += 1
-    else:
-        gUnsupportedCategories[category] = 1
+    event_type = _CATEGORIES.get(category)
+    if event_type is not None:
+        return event_type
 
+    gUnsupportedCategories[category] = gUnsupportedCategories.get(category, 0) + 1
     return None
 
 
@@ -102,6 +114,63 @@ class ActivityMonitoringRule:
     This class wraps a [ActivityMonitoringRule] configuration block.
     """
 
+    # Caches the EventType specific part of the configuration block per EventType.
+    _event_type_block_cache = {}
+
+    # Tag prefixes per EventType.
+    tag_prefixes = {
+        "Process.Start": "proc-start"
+    }
+
+    # Specifies the properties that are being evaluated and send to the backend
+    # if an Activity Monitoring rule is matched.
+    generic_properties = {
+        "Process.": [
+            "Process.Hash.MD5",
+            "Process.Hash.SHA1",
+            "Process.Hash.SHA256",
+            "Process.Hash.IMP"
+        ],
+        "Image.": [
+            "Image.Name",
+            "Image.Path",
+            "Image.Hash.MD5",
+            "Image.Hash.SHA1",
+            "Image.Hash.SHA256",
+            "Image.Hash.IMP"
+        ],
+        "Net.": [
+            "Net.Target.Ip",
+            "Net.Target.Name",
+            "Net.Target.Port",
+            "Net.Target.Protocol",
+            "Net.Source.Ip",
+            "Net.Source.Port",
+        ],
+        "Reg.": [
+            "Reg.Key.Path",
+            "Reg.Key.Path.New",
+            "Reg.Key.Path.Old",
+            "Reg.Key.Name",
+            "Reg.Parent.Key.Path",
+            "Reg.Value.Name",
+            "Reg.File.Name",
+            "Reg.Key.Sddl",
+            "Reg.Key.Hive",
+            "Reg.Key.Target"
+        ],
+        "Dns.": [
+            "Dns.QueryRequest",
+            "Dns.QueryResponse"
+        ]
+    }
+
+    # The numbered GenericProperty lines per EventType prefix. Generic properties are limited to 10.
+    _GENERIC_PROPERTY_BLOCKS = {
+        prefix: "".join("GenericProperty{} = {}\n".format(i, prop) for i, prop in enumerate(props[:10], 1))
+        for prefix, props in generic_properties.items()
+    }
+
     def __init__(self):
         self.name = ""
         self.event_type = None
@@ -111,49 +180,6 @@ class ActivityMonitoringRule:
         self.description = ""
         self.sigma_level = ""
 
-        # Specifies the properties that are being evaluated and send to the backend
-        # if an Activity Monitoring rule is matched.
-        self.generic_properties = {
-            "Process.": [
-                "Process.Hash.MD5",
-                "Process.Hash.SHA1",
-                "Process.Hash.SHA256",
-                "Process.Hash.IMP"
-            ],
-            "Image.": [
-                "Image.Name",
-                "Image.Path",
-                "Image.Hash.MD5",
-                "Image.Hash.SHA1",
-                "Image.Hash.SHA256",
-                "Image.Hash.IMP"
-            ],
-            "Net.": [
-                "Net.Target.Ip",
-                "Net.Target.Name",
-                "Net.Target.Port",
-                "Net.Target.Protocol",
-                "Net.Source.Ip",
-                "Net.Source.Port",
-            ],
-            "Reg.": [
-                "Reg.Key.Path",
-                "Reg.Key.Path.New",
-                "Reg.Key.Path.Old",
-                "Reg.Key.Name",
-                "Reg.Parent.Key.Path",
-                "Reg.Value.Name",
-                "Reg.File.Name",
-                "Reg.Key.Sddl",
-                "Reg.Key.Hive",
-                "Reg.Key.Target"
-            ],
-            "Dns.": [
-                "Dns.QueryRequest",
-                "Dns.QueryResponse"
-            ]
-        }
-
     def set_query(self, query):
         """Sets the generated query."""
         self.query = query
@@ -183,24 +209,32 @@ class ActivityMonitoringRule:
         self.description = description
 
     def _prefixed_tag(self):
-        prefixes = {
-            "Process.Start": "proc-start"
-        }
-
-        if self.event_type not in prefixes:
+        prefix = self.tag_prefixes.get(self.event_type)
+        if prefix is None:
             return self.tag
 
-        return "{}-{}".format(prefixes[self.event_type], self.tag)
+        return "{}-{}".format(prefix, self.tag)
 
-    def __str__(self):
-        """Builds and returns the [ActivityMonitoringRule] configuration block."""
-        result = "[ActivityMonitoringRule]\n"
+    def _event_type_block(self):
+        """Returns the part of the configuration block that only depends on the EventType."""
+        block = self._event_type_block_cache.get(self.event_type)
+        if block is not None:
+            return block
 
-        # The Description is optional.
-        if len(self.description) > 0:
-            for description_line in self.description.splitlines():
-                result += "# {}\n".format(description_line)
+        block = ""
+        if self.event_type == "Reg.Any":
+            block += "Hive = HKLM,HKU\n"
+
+        for event_type_prefix, properties in self._GENERIC_PROPERTY_BLOCKS.items():
+            if self.event_type.startswith(event_type_prefix):
+                block += properties
+                break
+
+        self._event_type_block_cache[self.event_type] = block
+        return block
 
+    def __str__(self):
+        """Builds and returns the [ActivityMonitoringRule] configuration block."""
         # Make sure all required properties have at least a value that is somehow usable.
         if self.event_type is None:
             raise MalformedRuleException()
@@ -214,32 +248,25 @@ class ActivityMonitoringRule:
         if len(self.query) == 0:
             raise MalformedRuleException()
 
-        result += "RuleName = {}\n".format(self.name)
-        result += "EventType = {}\n".format(self.event_type)
-        result += "Tag = {}\n".format(self._prefixed_tag())
+        parts = ["[ActivityMonitoringRule]\n"]
+
+        # The Description is optional.
+        for description_line in self.description.splitlines():
+            parts.append("# {}\n".format(description_line))
+
+        parts.append("RuleName = {}\n".format(self.name))
+        parts.append("EventType = {}\n".format(self.event_type))
+        parts.append("Tag = {}\n".format(self._prefixed_tag()))
 
         # The RiskScore is optional.
         # Set it, if a risk_score value is present.
         if self.risk_score > 0:
-            result += "RiskScore = {}\n".format(self.risk_score)
-
-        result += "Query = {}\n".format(self.query)
+            parts.append("RiskScore = {}\n".format(self.risk_score))
 
-        if self.event_type == "Reg.Any":
-            result += "Hive = HKLM,HKU\n"
+        parts.append("Query = {}\n".format(self.query))
+        parts.append(self._event_type_block())
 
-        counter = 1
-        for event_type_prefix in self.generic_properties:
-            if self.event_type.startswith(event_type_prefix):
-                for prop in self.generic_properties[event_type_prefix]:
-                    # Generic properties are limited to 10.
-                    if counter > 10:
-                        break
-
-                    result += "GenericProperty{} = {}\n".format(counter, prop)
-                    counter += 1
-
-        return result
+        return "".join(parts)
 
 
 def get_parser_properties(sigmaparser):
@@ -388,7 +415,7 @@ class uberAgentBackend(SingleTextQueryBackend):
 
     # We ignore some fields that we don't support yet but we don't want them to
     # throw errors in the console since we are aware of this.
-    ignoreFieldList = [
+    ignoreFieldList = frozenset({
         "description",
         "product",
         "logonid",
@@ -408,26 +435,53 @@ class uberAgentBackend(SingleTextQueryBackend):
         "sourceimage",
         "eventtype",
         "details"
-    ]
-
-    rules = []
+    })
+
+    # Output file per Sigma rule level. Rules of other levels are not written.
+    level_file_names = {
+        "critical": "uberAgent-ESA-am-sigma-critical.conf",
+        "high": "uberAgent-ESA-am-sigma-high.conf",
+        "low": "uberAgent-ESA-am-sigma-low.conf",
+        "medium": "uberAgent-ESA-am-sigma-medium.conf"
+    }
 
-    def fieldNameMapping(self, fieldname, value):
-        key = fieldname.lower()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rule_count = 0
+        self.level_counts = dict.fromkeys(self.level_file_names, 0)
+        self.level_files = {}
+
+        # Value kind to generator lookup used by generateMapItemNode
+        self._value_handlers = {
+            "csv": self._emit_csv,
+            "list": self._emit_list,
+            "wildcard": self._emit_wildcard,
+            "map": self._emit_map,
+        }
 
-        if self.current_category is not None:
-            if self.current_category in self.fieldMappingPerCategory:
-                if key in self.fieldMappingPerCategory[self.current_category]:
-                    return self.fieldMappingPerCategory[self.current_category][key]
+    def _resolve_field(self, category, key):
+        """Resolves the lowercased field name for the given category to (uberAgent field, is ignored)."""
+        if category is not None:
+            if category in self.fieldMappingPerCategory:
+                if key in self.fieldMappingPerCategory[category]:
+                    return self.fieldMappingPerCategory[category][key], False
 
         if key not in self.fieldMapping:
-            if key in self.ignoreFieldList:
+            return None, key in self.ignoreFieldList
+
+        return self.fieldMapping[key], False
+
+    def fieldNameMapping(self, fieldname, value):
+        mapping, is_ignored = self._resolve_field(self.current_category, fieldname.lower())
+
+        if mapping is None:
+            if is_ignored:
                 raise IgnoreFieldException()
             else:
                 raise NotImplementedError(
                     'The field name %s in category %s is not implemented.' % (fieldname, self.current_category))
 
-        return self.fieldMapping[key]
+        return mapping
 
     def generateQuery(self, parsed):
         if parsed.parsedAgg:
@@ -435,6 +489,51 @@ class uberAgentBackend(SingleTextQueryBackend):
 
         return self.generateNode(parsed.parsedSearch)
 
+    def _is_ignored_node(self, node):
+        """
+        Walks the parse tree in the order generateNode would and reports whether generating it would end
+        in one of the Ignore* exceptions. Returns True if so, False if generation would fail otherwise
+        (e.g. with an unknown field) and None if nothing in the tree is known to stop generation.
+        """
+        if type(node) in (ConditionAND, ConditionOR):
+            for item in node:
+                result = self._is_ignored_node(item)
+                if result is not None:
+                    return result
+        elif type(node) == ConditionNOT:
+            return self._is_ignored_node(node.item)
+        elif type(node) == NodeSubexpression:
+            return self._is_ignored_node(node.items)
+        elif type(node) == tuple:
+            fieldname, value = node
+            mapping, is_ignored = self._resolve_field(self.current_category, fieldname.lower())
+            if mapping is None:
+                return is_ignored
+            if value is None:
+                return None
+            # generateNode raises TypeError for any other value type, e.g. bool or float.
+            if type(value) not in (str, int, list) and not isinstance(value, SigmaTypeModifier):
+                return False
+            return self._is_ignored_node(value)
+        elif type(node) == list:
+            # generateListNode raises TypeError for anything but strings and numbers.
+            if not set([type(value) for value in node]).issubset({str, int}):
+                return False
+        elif isinstance(node, SigmaTypeModifier):
+            return True
+        return None
+
+    def _is_ignored_rule(self, sigmaparser):
+        """Cheap check for rules that would be dropped anyway, done before the parse tree is generated."""
+        if len(sigmaparser.condparsed) != 1:
+            return False
+
+        parsed = sigmaparser.condparsed[0]
+        if parsed.parsedAgg:
+            return True
+
+        return self._is_ignored_node(parsed.parsedSearch) is True
+
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
         product, category, service, title, level, condition, description = get_parser_properties(sigmaparser)
@@ -449,6 +548,10 @@ class uberAgentBackend(SingleTextQueryBackend):
 
         self.current_category = category
 
+        # Skip generating rules that would be dropped because of ignored fields, modifiers or aggregations.
+        if self._is_ignored_rule(sigmaparser):
+            return ""
+
         try:
             rule = ActivityMonitoringRule()
 
@@ -461,8 +564,9 @@ class uberAgentBackend(SingleTextQueryBackend):
                 rule.set_risk_score(convert_sigma_level_to_uberagent_risk_score(level))
                 rule.set_sigma_level(level)
                 rule.set_description(description)
-                self.rules.append(rule)
+                self.rule_count += 1
                 print("Generated rule <{}>.. [level: {}]".format(rule.name, level))
+                self.write_rule(rule)
         except IgnoreTypedModifierException:
             return ""
         except IgnoreAggregationException:
@@ -472,32 +576,44 @@ class uberAgentBackend(SingleTextQueryBackend):
         except MalformedRuleException:
             return ""
 
-    def serialize_file(self, name, level):
-        count = 0
-        with open(name, "w", encoding='utf8') as file:
+    def _level_file(self, level):
+        """
+        Returns the output file for the given level, creating it on first use. Rules are written to an
+        anonymous temporary file that finalize copies into place, so an aborted run neither touches
+        earlier output nor leaves files behind.
+        """
+        file = self.level_files.get(level)
+        if file is None:
+            file = tempfile.TemporaryFile("w+", encoding='utf8')
             write_file_header(file, level)
-            for rule in self.rules:
-                try:
-                    serialized_rule = str(rule)
-                    if rule.sigma_level == level:
-                        file.write(serialized_rule + "\n")
-                        count = count + 1
-                except MalformedRuleException:
-                    continue
-            file.close()
-        return count
+            self.level_files[level] = file
+        return file
+
+    def write_rule(self, rule):
+        if rule.sigma_level not in self.level_file_names:
+            return
+
+        try:
+            serialized_rule = str(rule)
+        except MalformedRuleException:
+            return
+
+        self._level_file(rule.sigma_level).write(serialized_rule + "\n")
+        self.level_counts[rule.sigma_level] += 1
 
     def finalize(self):
-        count_critical = self.serialize_file("uberAgent-ESA-am-sigma-critical.conf", "critical")
-        count_high = self.serialize_file("uberAgent-ESA-am-sigma-high.conf", "high")
-        count_low = self.serialize_file("uberAgent-ESA-am-sigma-low.conf", "low")
-        count_medium = self.serialize_file("uberAgent-ESA-am-sigma-medium.conf", "medium")
-        print("Generated {} activity monitoring rules..".format(len(self.rules)))
+        for level, name in self.level_file_names.items():
+            with self._level_file(level) as file, open(name, "w", encoding='utf8') as output:
+                file.seek(0)
+                shutil.copyfileobj(file, output)
+
+        print("Generated {} activity monitoring rules..".format(self.rule_count))
         print(
-            "This includes {} critical rules, {} high rules, {} medium rules and {} low rules..".format(count_critical,
-                                                                                                        count_high,
-                                                                                                        count_medium,
-                                                                                                        count_low))
+            "This includes {} critical rules, {} high rules, {} medium rules and {} low rules..".format(
+                self.level_counts["critical"],
+                self.level_counts["high"],
+                self.level_counts["medium"],
+                self.level_counts["low"]))
 
         print("There are %d unsupported categories." % len(gUnsupportedCategories))
         for category in gUnsupportedCategories:
@@ -519,42 +635,53 @@ class uberAgentBackend(SingleTextQueryBackend):
         if value is None:
             return self.nullExpression % (transformed_fieldname,)
 
-        has_wildcard = re.search(r"((\\(\*|\?|\\))|\*|\?|_|%)", self.generateNode(value))
+        rendered = self.generateNode(value)
+        kind = self._classify_value(value, rendered)
+        if kind is None:
+            raise TypeError("Backend does not support map values of type " + str(type(value)))
+
+        return self._value_handlers[kind](transformed_fieldname, value, rendered)
+
+    def _classify_value(self, value, rendered):
+        """Returns which expression a map item value is rendered with, or None if the value is not supported."""
+        has_wildcard = _RE_WILDCARD.search(rendered)
 
-        if "," in self.generateNode(value) and not has_wildcard:
-            return self.mapListValueExpression % (transformed_fieldname, self.generateNode(value))
+        if "," in rendered and not has_wildcard:
+            return "csv"
         elif type(value) == list:
-            return self.generateMapItemListNode(transformed_fieldname, value)
+            return "list"
         elif self.mapListsSpecialHandling == False and type(value) in (
                 str, int, list) or self.mapListsSpecialHandling == True and type(value) in (str, int):
-            if has_wildcard:
-                return self.mapWildcard % (transformed_fieldname, self.generateNode(value))
-            else:
-                return self.mapExpression % (transformed_fieldname, self.generateNode(value))
+            return "wildcard" if has_wildcard else "map"
         elif has_wildcard:
-            return self.mapWildcard % (transformed_fieldname, self.generateNode(value))
-        else:
-            raise TypeError("Backend does not support map values of type " + str(type(value)))
+            return "wildcard"
+        return None
+
+    def _emit_csv(self, fieldname, value, rendered):
+        return self.mapListValueExpression % (fieldname, rendered)
+
+    def _emit_list(self, fieldname, value, rendered):
+        return self.generateMapItemListNode(fieldname, value)
+
+    def _emit_wildcard(self, fieldname, value, rendered):
+        return self.mapWildcard % (fieldname, rendered)
+
+    def _emit_map(self, fieldname, value, rendered):
+        return self.mapExpression % (fieldname, rendered)
 
     def cleanValue(self, val):
         if not isinstance(val, str):
             return str(val)
 
-        # Single backlashes which are not in front of * or ? are doubled
-        val = re.sub(r"(?<!\\)\\(?!(\\|\*|\?))", r"\\\\", val)
+        val = _RE_ESC_BS.sub(r"\\\\", val)
 
         # Replace _ with \_ because _ is a sql wildcard
-        val = re.sub(r'_', r'\_', val)
+        val = val.replace("_", r"\_")
 
         # Replace % with \% because % is a sql wildcard
-        val = re.sub(r'%', r'\%', val)
-
-        # Replace " with \" because " is a string literal symbol and must be escaped
-        val = re.sub(r'"', r'\"', val)
-
-        # Replace * with %, if even number of backslashes (or zero) in front of *
-        val = re.sub(r"(?<!\\)(\\\\)*(?!\\)\*", r"\1%", val)
+        val = val.replace("%", r"\%")
 
-        # Replace ? with _, if even number of backslashes (or zero) in front of ?
-        val = re.sub(r"(?<!\\)(\\\\)*(?!\\)\?", r"\1_", val)
+        val = _RE_QUOT.sub(r'\"', val)
+        val = _RE_STAR.sub(r"\1%", val)
+        val = _RE_QMARK.sub(r"\1_", val)
         return val
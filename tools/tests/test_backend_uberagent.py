@@ -0,0 +1,124 @@
+# Test output backends for sigmac
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest.mock import patch
+
+from sigma.backends.base import SingleTextQueryBackend
+from sigma.backends.uberagent import uberAgentBackend, IgnoreAggregationException, IgnoreFieldException, \
+    IgnoreTypedModifierException
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.condition import ConditionAND
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
+from sigma.configuration import SigmaConfiguration
+
+IGNORED = "ignored"
+FAILED = "failed"
+GENERATED = "generated"
+
+
+class TestUberAgentIgnoredRuleCheck(unittest.TestCase):
+    """The early _is_ignored_rule check has to agree with what full generation would do."""
+
+    def setUp(self):
+        self.basic_rule = {
+            "title": "uberAgent Backend Test",
+            "level": "medium",
+            "description": "",
+            "logsource": {"category": "process_creation", "product": "windows"}
+        }
+        self.config = SigmaConfiguration()
+        self.backend = uberAgentBackend(self.config, {})
+        self.backend.current_category = "process_creation"
+
+    def generation_outcome(self, generate, *args):
+        try:
+            generate(*args)
+        except (IgnoreAggregationException, IgnoreFieldException, IgnoreTypedModifierException):
+            return IGNORED
+        except Exception:
+            return FAILED
+        return GENERATED
+
+    def validate(self, detection, expectation):
+        self.basic_rule["detection"] = detection
+
+        with patch("yaml.safe_load_all", return_value=[self.basic_rule]):
+            parser = SigmaCollectionParser("any sigma io", self.config, None)
+
+        for p in parser.parsers:
+            outcome = self.generation_outcome(SingleTextQueryBackend.generate, self.backend, p)
+            self.assertEqual(expectation, outcome)
+            self.assertEqual(outcome == IGNORED, self.backend._is_ignored_rule(p))
+
+    def testSupportedFields(self):
+        detection = {"selection": {"CommandLine": "whoami", "Image": ["a.exe", "b.exe"]},
+                     "condition": "selection"}
+        self.validate(detection, GENERATED)
+
+    def testIgnoredField(self):
+        detection = {"selection": {"CommandLine": "whoami", "LogonId": "5"},
+                     "condition": "selection"}
+        self.validate(detection, IGNORED)
+
+    def testIgnoredFieldInNegation(self):
+        detection = {"selection": {"CommandLine": "whoami"},
+                     "filter": {"IntegrityLevel": "System"},
+                     "condition": "selection and not filter"}
+        self.validate(detection, IGNORED)
+
+    def testUnknownFieldBeforeIgnoredField(self):
+        detection = {"selection": {"UnknownField": "whoami", "LogonId": "5"},
+                     "condition": "selection"}
+        self.validate(detection, FAILED)
+
+    def testIgnoredFieldBeforeUnknownField(self):
+        detection = {"selection": {"LogonId": "5", "UnknownField": "whoami"},
+                     "condition": "selection"}
+        self.validate(detection, IGNORED)
+
+    def testBoolValueBeforeIgnoredField(self):
+        self.basic_rule["logsource"] = {"category": "network_connection", "product": "windows"}
+        self.backend.current_category = "network_connection"
+        detection = {"selection": {"DestinationIsIpv6": True, "Initiated": "true"},
+                     "condition": "selection"}
+        self.validate(detection, FAILED)
+
+    def testFloatValueBeforeIgnoredField(self):
+        detection = {"selection": {"CommandLine": 1.5, "LogonId": "5"},
+                     "condition": "selection"}
+        self.validate(detection, FAILED)
+
+    def testTypedModifier(self):
+        detection = {"selection": {"CommandLine|re": "who.*"},
+                     "condition": "selection"}
+        self.validate(detection, IGNORED)
+
+    def testAggregation(self):
+        detection = {"selection": {"CommandLine": "whoami"},
+                     "condition": "selection | count() > 5"}
+        self.validate(detection, IGNORED)
+
+    def testTypedModifierInList(self):
+        # generateListNode rejects the typed value with a TypeError before the ignored field is reached.
+        node = ConditionAND(None, None,
+                            ("CommandLine", [SigmaRegularExpressionModifier("who.*"), "x"]),
+                            ("LogonId", "5"))
+        self.assertEqual(FAILED, self.generation_outcome(self.backend.generateNode, node))
+        self.assertIs(False, self.backend._is_ignored_node(node))
+
+
+if __name__ == '__main__':
+    unittest.main()